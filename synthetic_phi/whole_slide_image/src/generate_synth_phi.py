@@ -1,12 +1,32 @@
 import argparse
 import os
-from os import listdir
-from os.path import isfile, join
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 from isyntax import deident_isyntax_file
 from svs import deident_svs_file
 import uuid
 
+
+# deident_file deidentifies a single slide and returns the status line to print, or None if the file type is not
+# supported. It runs in a worker process, so printing is left to the main process.
+def deident_file(ident_file_path, deident_file_path, file_extension, args):
+    if file_extension == '.isyntax':
+        # TODO: save deidentification metadata (label, macro, uuid filename mapping)
+        if deident_isyntax_file(ident_file_path, deident_file_path):
+            return 'iSyntax ' + ident_file_path + ' -> deident -> ' + deident_file_path
+        else:
+            return 'iSyntax failed deident: ' + ident_file_path
+
+    elif file_extension == '.svs':
+        if deident_svs_file(ident_file_path, deident_file_path, args):
+            return 'SVS ' + ident_file_path + ' -> deident -> ' + deident_file_path
+        else:
+            return 'SVS failed deident: ' + ident_file_path
+
+    return None
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='WSI Slide Deidentifier')
 
@@ -21,27 +41,29 @@ if __name__ == '__main__':
     # parser.add_argument('--hash_before', type=int, default=1, help='Compute the hash of file before deidentification')  # Cheap to compute, part of copy.
     parser.add_argument('--hash_after', type=int, default=1, help='Compute the hash of file after deidentification')
     parser.add_argument('--decode_barcode', type=int, default=1, help='Decode the barcode, if present.')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(),
+                        help='Number of slides to deidentify in parallel. Lower it if slides share a single disk.')
 
     args = parser.parse_args()
 
     slide_map = dict()
-    onlyfiles = [f for f in listdir(args.identified_slides_path) if isfile(join(args.identified_slides_path, f))]
-
-    for file in onlyfiles:
-        filename, file_extension = os.path.splitext(file)
-        ident_file_path = os.path.join(args.identified_slides_path, file)
-        out_file = file if args.rename_to_uuid == 0 else str(uuid.uuid1()) + file_extension
-        deident_file_path = os.path.join(args.deidentified_slides_path, 'deident_' + out_file)
-
-        if file_extension == '.isyntax':
-            # TODO: save deidentification metadata (label, macro, uuid filename mapping)
-            if deident_isyntax_file(ident_file_path, deident_file_path):
-                print('iSyntax ' + ident_file_path + ' -> deident -> ' + deident_file_path)
-            else:
-                print('iSyntax failed deident: ' + ident_file_path)
-
-        elif file_extension == '.svs':
-            if deident_svs_file(ident_file_path, deident_file_path, args):
-                print('SVS ' + ident_file_path + ' -> deident -> ' + deident_file_path)
-            else:
-                print('SVS failed deident: ' + ident_file_path)
+    # DirEntry.is_file() uses the file type from the directory listing, without a stat call per file.
+    with os.scandir(args.identified_slides_path) as entries:
+        onlyfiles = [entry for entry in entries if entry.is_file()]
+
+    ident_file_paths = []
+    deident_file_paths = []
+    file_extensions = []
+    for entry in onlyfiles:
+        filename, file_extension = os.path.splitext(entry.name)
+        ident_file_paths.append(entry.path)
+        out_file = entry.name if args.rename_to_uuid == 0 else str(uuid.uuid1()) + file_extension
+        deident_file_paths.append(os.path.join(args.deidentified_slides_path, 'deident_' + out_file))
+        file_extensions.append(file_extension)
+
+    # Slides are independent of each other, deidentify them in parallel.
+    with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+        for message in executor.map(deident_file, ident_file_paths, deident_file_paths, file_extensions,
+                                    repeat(args)):
+            if message is not None:
+                print(message)
@@ -1,22 +1,44 @@
 '''
 Original function taken from: https://github.com/pearcetm/svs-deidentifier with MIT License
 '''
+import ctypes
 import os
+import re
 import shutil
 import struct
+import sys
 import traceback
-import uuid
 import json
+import mmap
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 import tifffile
 from PIL import Image
 import numpy as np
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Read/modify TIFF files (as in the SVS files) using tiffparser library (stripped down tifffile lib)
 
 TIFF_IMAGE_DESCRIPTION_TAG_CODE = 270
 
+# Chunk size used when hashing/copying slides; a multiple of the page size.
+HASH_BUF_SIZE = 16 * 1024 * 1024
+
+# shutil.copyfile copies in the kernel on Linux (sendfile) and macOS (fcopyfile); elsewhere it reads and writes through
+# Python buffers.
+HAS_KERNEL_COPY = (sys.platform.startswith('linux') and hasattr(os, 'sendfile')) or sys.platform == 'darwin'
+
+# Suffix of the in-progress copy of a slide being deidentified.
+PARTIAL_SUFFIX = '.partial'
+
+# Labels larger than this (in pixels, either side) are downscaled before searching for the DataMatrix barcode.
+BARCODE_MAX_SEARCH_SIZE = 800
+
 DESCRIPTION_KEY_WHITELIST = [
     # Datetime
     'Date',
@@ -48,120 +70,209 @@ DESCRIPTION_KEY_WHITELIST = [
     'CalibrationAverageRed',
     'Scan Warning',
 ]
+_DESCRIPTION_KEY_WHITELIST_SET = frozenset(DESCRIPTION_KEY_WHITELIST)
 
-def write_bytes_with_debug(fp, some_bytes, name):
-    # print(f'{fp.tell()=} {len(some_bytes)=} {name=} {some_bytes[:8]=}')
-    fp.write(some_bytes)
+# A single key=value description entry; the key is captured without surrounding whitespace.
+_DESCRIPTION_KV_PATTERN = re.compile(r'\s*([^=]*?)\s*=[^=]*')
 
+# fallocate(2) modes, from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
 
 
-# delete_associated_image will remove a label or macro image from an SVS file
-def delete_associated_image(slide_path, image_type, keep_image_entry):
-    # THIS WILL ONLY WORK FOR STRIPED IMAGES CURRENTLY, NOT TILED
+def _load_fallocate():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    fallocate.restype = ctypes.c_int
+    return fallocate
 
-    allowed_image_types = ['label', 'macro'];
-    if image_type not in allowed_image_types:
-        raise Exception('Invalid image type requested for deletion')
 
-    with open(slide_path, 'r+b') as fp:
-        t = tifffile.TiffFile(fp)
-
-        # logic here will depend on file type. AT2 and older SVS files have "label" and "macro"
-        # strings in the page descriptions, which identifies the relevant pages to modify.
-        # in contrast, the GT450 scanner creates svs files which do not have this, but the label
-        # and macro images are always the last two pages and are striped, not tiled.
-        # The header of the first page will contain a description that indicates which file type it is
-        first_page = t.pages[0]
-        filtered_pages = []
-        if 'Aperio Image Library' in first_page.description:
-            filtered_pages = [page for page in t.pages if image_type in page.description]
-        elif 'Aperio Leica Biosystems GT450' in first_page.description:
-            if image_type == 'label':
-                filtered_pages = [t.pages[-2]]
-            else:
-                filtered_pages = [t.pages[-1]]
+_fallocate = _load_fallocate()
+
+
+def write_bytes_with_debug(mm, offset, some_bytes, name):
+    # print(f'{offset=} {len(some_bytes)=} {name=} {bytes(some_bytes[:8])=}')
+    mm[offset:offset + len(some_bytes)] = some_bytes
+
+
+# punch_hole deallocates a byte range of the file so that it reads back as zeros, without writing them.
+# Returns False if the platform or filesystem does not support it, in which case the caller writes the zeros.
+# Any buffered writes must be flushed by the caller beforehand.
+def punch_hole(fd, offset, length):
+    if _fallocate is None:
+        return False
+    return _fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+# coalesce_ranges merges (offset, bytecount) pairs that are adjacent in the file, e.g. the StripOffsets of an image
+# that are usually stored back to back, so that each run can be erased with a single call.
+def coalesce_ranges(offsets, bytecounts):
+    ranges = []
+    for (o, b) in sorted(zip(offsets, bytecounts)):
+        if ranges and o <= ranges[-1][0] + ranges[-1][1]:
+            start, length = ranges[-1]
+            ranges[-1] = (start, max(length, o + b - start))
         else:
-            # default to old-style labeled pages
-            filtered_pages = [page for page in t.pages if image_type in page.description]
-
-        num_results = len(filtered_pages)
-        if num_results > 1:
-            raise Exception(f'Invalid SVS format: duplicate associated {image_type} images found')
-        if num_results == 0:
-            # No image of this type in the WSI file; no need to delete it
+            ranges.append((o, b))
+    return ranges
+
+
+# scan_ifds walks the IFD chain of a memory mapped TIFF file once, recording for every page the offset of its IFD, the
+# location of its pointer to the next IFD and the value of that pointer.
+def scan_ifds(mm, t):
+    # precompile the formats once instead of having struct.unpack parse them for every page
+    tagno_struct = struct.Struct(t.tiff.tagnoformat)
+    offset_struct = struct.Struct(t.tiff.offsetformat)
+    tagsize = t.tiff.tagsize
+
+    # start by saving this page's IFD offset
+    ifds = [{'this': p.offset} for p in t.pages]
+    # now add the next page's location and offset to that pointer
+    for p in ifds:
+        # read the number of tags in this page
+        (num_tags,) = tagno_struct.unpack_from(mm, p['this'])
+
+        # the offset to the IFD of the next page follows the tag definitions
+        p['next_ifd_offset'] = p['this'] + tagno_struct.size + num_tags * tagsize
+        # read and save the value of the offset to the next page
+        (p['next_ifd_value'],) = offset_struct.unpack_from(mm, p['next_ifd_offset'])
+
+    return ifds
+
+
+# page_byte_ranges lists the (offset, bytecount) ranges of the file used by a page: its IFD, its tag values and its
+# image data. pageifd is the page's entry from scan_ifds.
+def page_byte_ranges(page, pageifd, offsetsize):
+    ranges = [(pageifd['this'], pageifd['next_ifd_offset'] + offsetsize - pageifd['this'])]
+    ranges += [(tag.valueoffset, tag.valuebytecount) for tag in page.tags.values()]
+    ranges += [(o, b) for (o, b) in zip(page.dataoffsets, page.databytecounts) if b > 0]
+    return ranges
+
+
+# tail_cut returns the offset at which the file can be truncated to drop the given page, i.e. the first byte used by
+# the page, if no other linked page uses anything at or after it. Otherwise returns None.
+def tail_cut(t, by_this, page):
+    offsetsize = t.tiff.offsetsize
+    cut = min(o for (o, _) in page_byte_ranges(page, by_this[page.offset], offsetsize))
+    for p in t.pages:
+        if p.offset == page.offset or p.offset not in by_this:
+            continue
+        if any(o + b > cut for (o, b) in page_byte_ranges(p, by_this[p.offset], offsetsize)):
             return None
+    return cut
+
+
+# _delete_associated_image will remove a label or macro image from an SVS file. It works on an already opened file, a
+# writable memory map of it, its TiffFile and its IFD list (see scan_ifds), so that several images can be removed
+# without re-parsing the file. t must be opened on mm, so that tifffile and the raw edits share one view of the file.
+# ifds is kept up to date when a page is unlinked.
+# Returns the pixels of the removed image, decoded only if decode_image is set as decoding is wasted work when nobody
+# consumes the image, and the offset the caller has to truncate the file at once mm is closed, or None.
+# The latter is only set for GT450 files, whose macro image sits at the end of the file: unlinking it and cutting the
+# file there replaces erasing its data.
+def _delete_associated_image(fp, mm, t, ifds, descriptions, image_type, keep_image_entry, decode_image):
+    # THIS WILL ONLY WORK FOR STRIPED IMAGES CURRENTLY, NOT TILED
 
-        # At this point, exactly 1 image has been identified to remove
-        page = filtered_pages[0]
-        image = page.asarray()
+    allowed_image_types = ['label', 'macro'];
+    if image_type not in allowed_image_types:
+        raise Exception('Invalid image type requested for deletion')
 
-        # get the list of IFDs for the various pages
-        offsetformat = t.tiff.offsetformat
-        offsetsize = t.tiff.offsetsize
-        tagnoformat = t.tiff.tagnoformat
-        tagnosize = t.tiff.tagnosize
-        tagsize = t.tiff.tagsize
-        unpack = struct.unpack
-
-        # start by saving this page's IFD offset
-        ifds = [{'this': p.offset} for p in t.pages]
-        # now add the next page's location and offset to that pointer
-        for p in ifds:
-            # move to the start of this page
-            fp.seek(p['this'])
-            # read the number of tags in this page
-            (num_tags,) = unpack(tagnoformat, fp.read(tagnosize))
-
-            # move forward past the tag defintions
-            fp.seek(num_tags * tagsize, 1)
-            # add the current location as the offset to the IFD of the next page
-            p['next_ifd_offset'] = fp.tell()
-            # read and save the value of the offset to the next page
-            (p['next_ifd_value'],) = unpack(offsetformat, fp.read(offsetsize))
-
-        # filter out the entry corresponding to the desired page to remove
-        pageifd = [i for i in ifds if i['this'] == page.offset][0]
-        # find the page pointing to this one in the IFD list
-        previfd = [i for i in ifds if i['next_ifd_value'] == page.offset]
-        # check for errors
-        if len(previfd) == 0:
-            raise Exception('No page points to this one')
-            return
+    # logic here will depend on file type. AT2 and older SVS files have "label" and "macro"
+    # strings in the page descriptions, which identifies the relevant pages to modify.
+    # in contrast, the GT450 scanner creates svs files which do not have this, but the label
+    # and macro images are always the last two pages and are striped, not tiled.
+    # The header of the first page will contain a description that indicates which file type it is
+    # descriptions holds the description of every page as it is in the file now, i.e. after whitelist filtering;
+    # tifffile does not update page.description when a tag is overwritten.
+    filtered_pages = []
+    is_gt450 = False
+    if 'Aperio Image Library' in descriptions[0]:
+        filtered_pages = [page for page, description in zip(t.pages, descriptions) if image_type in description]
+    elif 'Aperio Leica Biosystems GT450' in descriptions[0]:
+        is_gt450 = True
+        if image_type == 'label':
+            filtered_pages = [t.pages[-2]]
         else:
-            previfd = previfd[0]
-
+            filtered_pages = [t.pages[-1]]
+    else:
+        # default to old-style labeled pages
+        filtered_pages = [page for page, description in zip(t.pages, descriptions) if image_type in description]
+
+    num_results = len(filtered_pages)
+    if num_results > 1:
+        raise Exception(f'Invalid SVS format: duplicate associated {image_type} images found')
+    if num_results == 0:
+        # No image of this type in the WSI file; no need to delete it
+        return None, None
+
+    # At this point, exactly 1 image has been identified to remove
+    page = filtered_pages[0]
+    image = page.asarray() if decode_image else None
+
+    # index the IFD list by the location of each IFD and by the IFD each one points to
+    by_this = {i['this']: i for i in ifds}
+    by_next = {i['next_ifd_value']: i for i in ifds}
+    # filter out the entry corresponding to the desired page to remove
+    pageifd = by_this[page.offset]
+    # find the page pointing to this one in the IFD list
+    previfd = by_next.get(page.offset)
+    # check for errors
+    if previfd is None:
+        raise Exception('No page points to this one')
+
+    # a removed last page of a GT450 file is cut off the end of the file instead of being erased
+    cut = None
+    if is_gt450 and not keep_image_entry and pageifd['next_ifd_value'] == 0:
+        cut = tail_cut(t, by_this, page)
+
+    if cut is None:
         # get the strip offsets and byte counts
         offsets = page.tags['StripOffsets'].value
         bytecounts = page.tags['StripByteCounts'].value
 
-        # iterate over the strips and erase the data
+        # iterate over runs of contiguous strips and erase the data. Runs are punched out of the file where supported;
+        # otherwise zeros are written from a single shared buffer rather than allocating a new bytes object per strip.
         # print('Deleting pixel data from image strips')
-        for (o, b) in zip(offsets, bytecounts):
-            fp.seek(o)
-            write_bytes_with_debug(fp, b'\0' * b, 'data')
+        ranges = coalesce_ranges(offsets, bytecounts)
+        zeros = None
+        for (o, b) in ranges:
+            if punch_hole(fp.fileno(), o, b):
+                continue
+            if zeros is None:
+                zeros = memoryview(bytearray(max(b for (_, b) in ranges)))
+            write_bytes_with_debug(mm, o, zeros[:b], 'data')
+
+    if not keep_image_entry:
+        offsetsize = t.tiff.offsetsize
+        offsetformat = t.tiff.offsetformat
 
-        if not keep_image_entry:
+        if cut is None:
             # iterate over all tags and erase values if necessary
             # print('Deleting tag values')
             for key, tag in page.tags.items():
-                fp.seek(tag.valueoffset)
-                write_bytes_with_debug(fp, b'\0' * tag.count, f'tag {key=}')  # TODO: should be valuebytecount?
+                # TODO: should be valuebytecount?
+                write_bytes_with_debug(mm, tag.valueoffset, b'\0' * tag.count, f'tag {key=}')
 
-            offsetsize = t.tiff.offsetsize
-            offsetformat = t.tiff.offsetformat
             pagebytes = (pageifd['next_ifd_offset'] - pageifd['this']) + offsetsize
 
             # next, zero out the data in this page's header
             # print('Deleting page header')
-            fp.seek(pageifd['this'])
-            write_bytes_with_debug(fp, b'\0' * pagebytes, 'header')
+            write_bytes_with_debug(mm, pageifd['this'], b'\0' * pagebytes, 'header')
 
-            # finally, point the previous page's IFD to this one's IFD instead
-            # this will make it not show up the next time the file is opened
-            fp.seek(previfd['next_ifd_offset'])
-            write_bytes_with_debug(fp, struct.pack(offsetformat, pageifd['next_ifd_value']), 'next_ifd_value')
+        # finally, point the previous page's IFD to this one's IFD instead
+        # this will make it not show up the next time the file is opened
+        write_bytes_with_debug(mm, previfd['next_ifd_offset'], struct.pack(offsetformat, pageifd['next_ifd_value']),
+                               'next_ifd_value')
+        previfd['next_ifd_value'] = pageifd['next_ifd_value']
+        ifds.remove(pageifd)
 
-        return image
+    return image, cut
 
 
 def filter_description_whitelist(description):
@@ -170,50 +281,107 @@ def filter_description_whitelist(description):
     # have a proper key.
     filtered_desc_kv_pairs = [desc_kv_pairs[0]]
     for i in range(1, len(desc_kv_pairs)):
-        entries = desc_kv_pairs[i].split('=')
-        assert len(entries) == 2  # Not expecting anything of the format ...|X=A=B|...
-        if entries[0].strip() in DESCRIPTION_KEY_WHITELIST:
-            filtered_desc_kv_pairs.append(f'{entries[0]}={entries[1]}')
+        match = _DESCRIPTION_KV_PATTERN.fullmatch(desc_kv_pairs[i])
+        if match is None:
+            # Not expecting anything of the format ...|X=A=B|... or ...|X|...
+            raise ValueError(f'Unexpected image description entry: {desc_kv_pairs[i]!r}')
+        if match.group(1) in _DESCRIPTION_KEY_WHITELIST_SET:
+            filtered_desc_kv_pairs.append(desc_kv_pairs[i])
         else:
-            # print(f'Dropping description {entries=}')
+            # print(f'Dropping description {desc_kv_pairs[i]=}')
             pass
 
     filtered_description = '|'.join(filtered_desc_kv_pairs)
     return filtered_description
 
 
-def filter_image_description_tag_whitelist(slide_path):
+# _filter_image_description_tag_whitelist filters the image descriptions of all pages in place. Returns the original
+# descriptions, and the filtered description of every page (as page.description would read after re-parsing the file).
+def _filter_image_description_tag_whitelist(t):
     identified_tags = {}  # Using map in case we would later prefer some other key, e.g. resolutions.
-    with open(slide_path, 'r+b') as fp:
-        t = tifffile.TiffFile(fp)
-        for page_index, page in enumerate(t.pages):
-            for key, tag in page.tags.items():
-                if key == TIFF_IMAGE_DESCRIPTION_TAG_CODE:
-                    # Preserve the original description in case needed later on.
-                    identified_tags[page_index] = tag.value
-                    filtered_description = filter_description_whitelist(tag.value)
+    descriptions = []
+    for page_index, page in enumerate(t.pages):
+        page_description = None
+        for key, tag in page.tags.items():
+            if key == TIFF_IMAGE_DESCRIPTION_TAG_CODE:
+                # Preserve the original description in case needed later on.
+                identified_tags[page_index] = tag.value
+                filtered_description = filter_description_whitelist(tag.value)
+                # Skip the write when every entry was whitelisted.
+                if filtered_description != tag.value:
                     tag.overwrite(filtered_description)
+                if page_description is None:
+                    page_description = filtered_description
+        descriptions.append(page.description if page_description is None else page_description)
+
+    return identified_tags, descriptions
 
-    return identified_tags
+
+# strip_identifying removes identifying information from an SVS file in place, parsing the file only once: the image
+# descriptions are filtered against the whitelist, then the label and macro images are erased. Returns the label and
+# macro pixels (None unless decoded on request) and the original image descriptions.
+def strip_identifying(slide_path, decode_label=False, decode_macro=False):
+    # tifffile parsing, the IFD walk and the erasing all go through a memory map of the file, which turns their many
+    # small reads and writes into memory accesses instead of seek/read/write system calls.
+    with open(slide_path, 'r+b') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_WRITE) as mm:
+            t = tifffile.TiffFile(mm)
+            ifds = scan_ifds(mm, t)
+
+            identified_tags, descriptions = _filter_image_description_tag_whitelist(t)
+
+            # Keep label image due to a bug in QuPath/bioformats (https://github.com/ome/bioformats/pull/3962). The
+            # contents (pixels) are removed, only the image record remains, and appears as black image in QuPath. The
+            # macro image below, if kept, results in a stack trace in QuPath. This seems to be due to jpeg vs lzw
+            # compression used.
+            label_image, _ = _delete_associated_image(fp, mm, t, ifds, descriptions, 'label',
+                                                      keep_image_entry=True, decode_image=decode_label)
+            macro_image, cut = _delete_associated_image(fp, mm, t, ifds, descriptions, 'macro',
+                                                        keep_image_entry=False, decode_image=decode_macro)
+        # truncate once the map is closed, a mapped file cannot be truncated on Windows
+        if cut is not None:
+            fp.truncate(cut)
+
+    return label_image, macro_image, identified_tags
 
 
 def copy_with_hash(source_file, dest_file):
-    BUF_SIZE = 1024 * 1024
+    if not HAS_KERNEL_COPY:
+        return copy_with_hash_streaming(source_file, dest_file)
+
+    # Hash the source in a worker thread while shutil.copyfile (sendfile/fcopyfile) copies it. Both release the GIL,
+    # and as both read the source at a similar pace, one of them is served from the page cache: slides larger than
+    # the cache are read from disk once, instead of copy followed by a second full read to hash.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        hash_future = executor.submit(compute_hash, source_file)
+        shutil.copyfile(source_file, dest_file)
+        return hash_future.result()
+
+
+# copy_with_hash_streaming copies and hashes in a single pass through a reusable buffer, for platforms where
+# shutil.copyfile would stream the data through Python anyway.
+def copy_with_hash_streaming(source_file, dest_file):
+    buf = bytearray(HASH_BUF_SIZE)
+    view = memoryview(buf)
     sha1 = hashlib.sha1()
     with open(source_file, 'rb') as f_src:
         with open(dest_file, 'wb') as f_dst:
-            while data := f_src.read(BUF_SIZE):
-                sha1.update(data)
-                f_dst.write(data)
+            while n := f_src.readinto(buf):
+                sha1.update(view[:n])
+                f_dst.write(view[:n])
     return sha1.hexdigest()
 
 
 def compute_hash(source_file):
-    BUF_SIZE = 1024 * 1024
-    sha1 = hashlib.sha1()
     with open(source_file, 'rb') as f_src:
-        while data := f_src.read(BUF_SIZE):
-            sha1.update(data)
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: hashes in C with a reusable buffer, releasing the GIL.
+            return hashlib.file_digest(f_src, 'sha1').hexdigest()
+        buf = bytearray(HASH_BUF_SIZE)
+        view = memoryview(buf)
+        sha1 = hashlib.sha1()
+        while n := f_src.readinto(buf):
+            sha1.update(view[:n])
     return sha1.hexdigest()
 
 
@@ -223,25 +391,54 @@ def save_label_macro_image(filename_prefix, target_path_or_none, image, original
         Image.fromarray(image).save(f'{target_path_or_none}/{filename_prefix}{image_filename}.png')
 
 
+def dump_json(obj):
+    # orjson serializes in C; fall back to the standard library when not installed. orjson writes non-ASCII text as
+    # raw UTF-8, so the fallback must not escape it for both to produce the same bytes.
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def decode_barcode(label_image):
+    from pylibdmtx.pylibdmtx import decode
+    # libdmtx run time scales with the image area and channel count. Search an 8-bit grayscale copy of the label, first
+    # at half resolution for large labels, and only fall back to the full resolution if no barcode is found there.
+    gray = Image.fromarray(label_image).convert('L')
+    candidates = [gray]
+    if max(gray.size) > BARCODE_MAX_SEARCH_SIZE:
+        candidates.insert(0, gray.resize((gray.width // 2, gray.height // 2), Image.BILINEAR))
+    for candidate in candidates:
+        barcode_result = decode(candidate)
+        if len(barcode_result) > 0:
+            return barcode_result[0].data.decode("utf-8")
+    return ''
+
+
 def deident_svs_file(original_file_path, deident_file_path, args):
+    # Strip the information in a copy next to the destination, which is renamed into place (same directory, so same
+    # filesystem) only once it is deidentified; the final name never holds identified data.
+    partial_file = deident_file_path + PARTIAL_SUFFIX
     try:
-        dst_path = os.path.dirname(deident_file_path)
-        tmp_file = os.path.join(dst_path, str(uuid.uuid1()))
-        # create a tmp file to strip information
-        hash_sha1_before = copy_with_hash(original_file_path, tmp_file)
+        # hash the original during the copy
+        hash_sha1_before = copy_with_hash(original_file_path, partial_file)
+
+        decode_label = args.label_image_path is not None or (args.identified_metadata_path is not None and
+                                                            args.decode_barcode)
+        label_image, macro_image, identified_tags = strip_identifying(
+            partial_file, decode_label=decode_label, decode_macro=args.macro_image_path is not None)
+
+        # The barcode decode (libdmtx, runs without the GIL) does not depend on the remaining steps. Run it in the
+        # background while the images are saved and the deidentified file is renamed and hashed.
+        barcode_future = None
+        if args.identified_metadata_path is not None and args.decode_barcode and label_image is not None:
+            executor = ThreadPoolExecutor(max_workers=1)
+            barcode_future = executor.submit(decode_barcode, label_image)
+            executor.shutdown(wait=False)
 
-        identified_tags = filter_image_description_tag_whitelist(tmp_file)
-
-        # Keep label image due to a bug in QuPath/bioformats (https://github.com/ome/bioformats/pull/3962). The contents
-        # (pixels) are removed, only the image record remains, and appears as black image in QuPath. The macro image
-        # below, if kept, results in a stack trace in QuPath. This seems to be due to jpeg vs lzw compression used.
-        label_image = delete_associated_image(tmp_file, 'label', keep_image_entry=True)
         save_label_macro_image('label_', args.label_image_path, label_image, original_file_path)
-
-        macro_image = delete_associated_image(tmp_file, 'macro', keep_image_entry=False)
         save_label_macro_image('macro_', args.macro_image_path, macro_image, original_file_path)
 
-        shutil.move(tmp_file, deident_file_path)
+        os.replace(partial_file, deident_file_path)
 
         if args.hash_after:
             hash_sha1_after = compute_hash(deident_file_path)
@@ -250,12 +447,7 @@ def deident_svs_file(original_file_path, deident_file_path, args):
 
         if args.identified_metadata_path is not None:
             metadata_filename = os.path.basename(original_file_path)
-            if args.decode_barcode:
-                from pylibdmtx.pylibdmtx import decode
-                barcode_result = decode(label_image)
-                barcode_result = '' if len(barcode_result) == 0 else barcode_result[0].data.decode("utf-8")
-            else:
-                barcode_result = ''
+            barcode_result = '' if barcode_future is None else barcode_future.result()
 
             metadata = {
                 'deident_filename': os.path.basename(deident_file_path),
@@ -264,10 +456,13 @@ def deident_svs_file(original_file_path, deident_file_path, args):
                 'hash_sha1_after': hash_sha1_after,
                 'tags': identified_tags,
             }
-            with open(f'{args.identified_metadata_path}/{metadata_filename}.json', "wt") as f:
-                f.write(json.dumps(metadata, indent=2))
+            with open(f'{args.identified_metadata_path}/{metadata_filename}.json', "wb") as f:
+                f.write(dump_json(metadata))
 
         return True
     except:
         traceback.print_exc()
+        # Do not leave a partially deidentified copy behind.
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
         return False